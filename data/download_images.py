@@ -4,14 +4,50 @@ Script to download images from URLs in the dataset and organize them
 according to the image path structure.
 """
 
-import json
 import os
-import requests
+import asyncio
+import logging
+import random
+import aiohttp
+import orjson
 import time
 import argparse
+from collections import defaultdict
 from pathlib import Path
 from urllib.parse import urlparse
 import hashlib
+from tqdm import tqdm
+from tqdm.contrib.logging import logging_redirect_tqdm
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 32
+DEFAULT_PER_HOST = 8
+
+# Bytes read from the response body per iteration
+DOWNLOAD_CHUNK_SIZE = 128 * 1024
+
+# Responses worth retrying; other HTTP errors fail immediately
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Backoff window in seconds after the first failed attempt, doubled after
+# each further failure, and the longest single wait
+RETRY_BACKOFF = 1.0
+RETRY_MAX_DELAY = 30.0
+
+# Completed entries between checkpoint writes
+CHECKPOINT_EVERY = 25
+
+# Suffix of files still being written; they are renamed once complete
+PARTIAL_SUFFIX = '.part'
+
+# Extensions counted as images in the directory summary
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
+
+# Sent with every request made through the shared session
+HEADERS = {
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+}
 
 def ensure_directory(file_path):
     """
@@ -22,52 +58,138 @@ def ensure_directory(file_path):
     """
     file_path.parent.mkdir(parents=True, exist_ok=True)
 
-def download_image(url, local_path, timeout=30, retries=3):
+def retry_delay(attempt, retry_after=None):
+    """
+    Compute how long to wait before retrying a failed download.
+    
+    A Retry-After header given in seconds is honored; otherwise the delay
+    is drawn uniformly from an exponentially growing window ("full jitter"),
+    so retries against an overloaded host are spread out instead of
+    arriving together.
+    
+    Args:
+        attempt (int): Zero-based index of the attempt that just failed
+        retry_after (str): Value of the Retry-After response header, if any
+        
+    Returns:
+        float: Delay in seconds
+    """
+    if retry_after is not None:
+        try:
+            return min(max(float(retry_after), 0.0), RETRY_MAX_DELAY)
+        except ValueError:
+            pass  # HTTP-date form, fall back to backoff
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BACKOFF * 2 ** attempt))
+
+def open_partial_file(partial_path):
+    """
+    Create the parent directory if needed and open a partial download for writing.
+    
+    Args:
+        partial_path (Path): Temporary path the image is written to
+        
+    Returns:
+        file: Binary file object opened for writing
+    """
+    ensure_directory(partial_path)
+    return open(partial_path, 'wb')
+
+def describe_error(error):
+    """
+    Describe an exception for the log, even one with an empty message.
+    
+    Args:
+        error (Exception): The exception raised by a download attempt
+        
+    Returns:
+        str: The exception message, or its type name (e.g. TimeoutError) when empty
+    """
+    return str(error) or type(error).__name__
+
+def discard_partial_file(f, partial_path):
+    """
+    Close and delete a partial download that failed part-way.
+    
+    Args:
+        f (file): File object the download was being written to
+        partial_path (Path): Temporary path the image was written to
+    """
+    f.close()
+    try:
+        os.unlink(partial_path)
+    except FileNotFoundError:
+        pass
+
+async def download_image(session, url, local_path, sem, timeout=30, retries=3):
     """
     Download an image from URL and save it to local path.
     
+    Connection errors, timeouts and the statuses in RETRY_STATUSES are
+    retried with backoff; any other HTTP error fails immediately.
+    
     Args:
+        session (aiohttp.ClientSession): Shared HTTP session
         url (str): URL to download from
         local_path (Path): Local path to save the image
-        timeout (int): Request timeout in seconds
+        sem (asyncio.Semaphore): Bounds the number of concurrent downloads;
+            released while waiting to retry
+        timeout (int): Seconds allowed to connect and between reads of the
+            body; a large image that keeps arriving is never cut off
         retries (int): Number of retry attempts
         
     Returns:
         bool: True if download successful, False otherwise
     """
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-    }
-    
     for attempt in range(retries):
+        retry_after = None
         try:
-            print(f"  Downloading from: {url}")
-            response = requests.get(url, headers=headers, timeout=timeout, stream=True)
-            response.raise_for_status()
+            async with sem:
+                logger.debug("Downloading from: %s", url)
+                client_timeout = aiohttp.ClientTimeout(total=None, sock_connect=timeout, sock_read=timeout)
+                async with session.get(url, timeout=client_timeout) as response:
+                    response.raise_for_status()
+                    
+                    # Write image data to a temporary file and move it into
+                    # place, so an interrupted download is never mistaken
+                    # for a complete one on resume. File calls run in worker
+                    # threads: on a slow or network disk a blocking write
+                    # would stall every download sharing the event loop
+                    partial_path = local_path.with_name(local_path.name + PARTIAL_SUFFIX)
+                    f = await asyncio.to_thread(open_partial_file, partial_path)
+                    try:
+                        async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                            await asyncio.to_thread(f.write, chunk)
+                        await asyncio.to_thread(f.close)
+                        await asyncio.to_thread(os.replace, partial_path, local_path)
+                    except BaseException:
+                        await asyncio.to_thread(discard_partial_file, f, partial_path)
+                        raise
             
-            # Ensure directory exists
-            ensure_directory(local_path)
+            logger.debug("Saved %s to: %s", url, local_path)
+            return True
             
-            # Write image data to file
-            with open(local_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
-                    if chunk:
-                        f.write(chunk)
+        except aiohttp.ClientResponseError as e:
+            if e.status not in RETRY_STATUSES:
+                logger.warning("Failed to download %s: %s", url, e)
+                break
+            if e.headers:
+                retry_after = e.headers.get('Retry-After')
+            error = e
             
-            print(f"  ✓ Successfully saved to: {local_path}")
-            return True
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = e
             
-        except requests.exceptions.RequestException as e:
-            print(f"  ✗ Attempt {attempt + 1} failed: {e}")
-            if attempt < retries - 1:
-                print(f"  Retrying in 2 seconds...")
-                time.sleep(2)
-            else:
-                print(f"  Failed to download after {retries} attempts")
-                
         except Exception as e:
-            print(f"  ✗ Unexpected error: {e}")
+            logger.warning("Unexpected error for %s: %s", url, describe_error(e))
             break
+        
+        if attempt < retries - 1:
+            delay = retry_delay(attempt, retry_after)
+            logger.info("Attempt %d failed for %s: %s, retrying in %.1f seconds",
+                        attempt + 1, url, describe_error(error), delay)
+            await asyncio.sleep(delay)
+        else:
+            logger.warning("Failed to download %s after %d attempts: %s", url, retries, describe_error(error))
     
     return False
 
@@ -92,7 +214,182 @@ def get_file_extension_from_url(url):
     # Default to PNG if can't determine
     return '.png'
 
-def download_dataset_images(dataset_file, base_download_dir="downloaded_images", resume=True):
+def scan_existing_files(base_path):
+    """
+    Collect the paths of all files already downloaded under base_path.
+    
+    One directory walk replaces a stat call per dataset entry, which is
+    much cheaper on large datasets and network filesystems.
+    
+    Args:
+        base_path (Path): Base directory for downloaded images
+        
+    Returns:
+        set: Normalized paths of the complete files found
+    """
+    existing = set()
+    for root, _, files in os.walk(base_path):
+        for name in files:
+            if not name.endswith(PARTIAL_SUFFIX):
+                existing.add(os.path.normpath(os.path.join(root, name)))
+    return existing
+
+def load_checkpoint(checkpoint):
+    """
+    Read the number of dataset lines already processed by a previous run.
+    
+    Args:
+        checkpoint (str): Path to the checkpoint file, or None
+        
+    Returns:
+        int: Number of leading lines to skip, 0 if there is no checkpoint
+    """
+    if not checkpoint or not os.path.exists(checkpoint):
+        return 0
+    with open(checkpoint, 'rb') as f:
+        return orjson.loads(f.read())['next_index']
+
+def save_checkpoint(checkpoint, next_index):
+    """
+    Atomically record that all dataset lines before next_index are processed.
+    
+    Args:
+        checkpoint (str): Path to the checkpoint file
+        next_index (int): Number of leading lines processed
+    """
+    tmp_path = checkpoint + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(orjson.dumps({'next_index': next_index}))
+    os.replace(tmp_path, checkpoint)
+
+def create_session(concurrency, per_host=DEFAULT_PER_HOST):
+    """
+    Create the HTTP session shared by all downloads.
+    
+    Connections are kept alive and pooled per host, so consecutive images
+    from the same server reuse one TCP/TLS connection instead of paying
+    for a new handshake each time.
+    
+    Args:
+        concurrency (int): Maximum number of open connections
+        per_host (int): Maximum number of open connections to one host
+        
+    Returns:
+        aiohttp.ClientSession: Session with the default headers applied
+    """
+    connector = aiohttp.TCPConnector(
+        limit=concurrency,
+        limit_per_host=per_host,
+        keepalive_timeout=60,
+        ttl_dns_cache=300,
+    )
+    return aiohttp.ClientSession(connector=connector, headers=HEADERS)
+
+async def _process_entry(session, sem, host_sem, line_num, image_url, local_file_path, existing, scheduled):
+    """
+    Download a single dataset entry unless it can be skipped.
+    
+    Args:
+        session (aiohttp.ClientSession): Shared HTTP session
+        sem (asyncio.Semaphore): Bounds the number of concurrent downloads
+        host_sem (asyncio.Semaphore): Bounds the concurrent downloads from
+            the host serving image_url
+        line_num (int): Line number of the entry in the dataset file
+        image_url (str): URL to download from
+        local_file_path (Path): Local path to save the image
+        existing (set): Normalized paths of files already downloaded, empty
+            when resume is disabled
+        scheduled (set): Paths already claimed by another entry, so that
+            images shared between entries are fetched only once
+        
+    Returns:
+        str: 'successful', 'failed' or 'skipped'
+    """
+    # Check if file already exists and resume is enabled
+    if os.path.normpath(local_file_path) in existing:
+        logger.debug("[%d] Skipping existing file: %s", line_num, local_file_path)
+        return 'skipped'
+    
+    if local_file_path in scheduled:
+        logger.debug("[%d] Skipping duplicate image: %s", line_num, local_file_path)
+        return 'skipped'
+    scheduled.add(local_file_path)
+    
+    logger.debug("[%d] Processing: %s", line_num, local_file_path)
+    
+    # Download the image. The host slot is taken before the global one so
+    # that entries queued behind a busy host do not hold up other hosts.
+    async with host_sem:
+        if await download_image(session, image_url, local_file_path, sem):
+            return 'successful'
+    return 'failed'
+
+async def _download_entries(entries, base_path, resume, concurrency, per_host, stats, checkpoint, line_count):
+    """
+    Process all dataset entries concurrently over one shared session.
+    
+    Args:
+        entries (list): (line_num, data) pairs parsed from the dataset file
+        base_path (Path): Base directory for downloaded images
+        resume (bool): Whether to skip already downloaded files
+        concurrency (int): Maximum number of downloads in flight
+        per_host (int): Maximum number of downloads in flight per host
+        stats (dict): Download statistics, updated in place
+        checkpoint (str): Path to the checkpoint file, or None
+        line_count (int): Number of lines in the dataset file
+        
+    Returns:
+        int: Number of leading dataset lines processed, stopping before the
+            first failed download so that it is retried on the next run
+    """
+    sem = asyncio.Semaphore(concurrency)
+    host_limiters = defaultdict(lambda: asyncio.Semaphore(per_host))
+    existing = scan_existing_files(base_path) if resume else set()
+    scheduled = set()
+    
+    # Index of the first entry that has not finished yet; every line before
+    # it is safe to skip on the next run. Failed entries never finish
+    finished = [False] * len(entries)
+    pending = 0
+    
+    def lines_done():
+        return entries[pending][0] - 1 if pending < len(entries) else line_count
+    
+    async def run(index, line_num, data):
+        image_url = data['image_url']
+        status = await _process_entry(
+            session, sem, host_limiters[urlparse(image_url).netloc], line_num,
+            image_url, base_path / data['image'], existing, scheduled
+        )
+        return index, status
+    
+    async with create_session(concurrency, per_host) as session:
+        tasks = [
+            asyncio.create_task(run(index, line_num, data))
+            for index, (line_num, data) in enumerate(entries)
+        ]
+        
+        with tqdm(total=len(tasks), desc="Downloading", unit="img") as progress:
+            for task in asyncio.as_completed(tasks):
+                index, status = await task
+                stats[status] += 1
+                progress.set_postfix(ok=stats['successful'], failed=stats['failed'],
+                                     skipped=stats['skipped'], refresh=False)
+                progress.update()
+                
+                finished[index] = status != 'failed'
+                while pending < len(entries) and finished[pending]:
+                    pending += 1
+                
+                done = stats['successful'] + stats['failed'] + stats['skipped']
+                if checkpoint and done % CHECKPOINT_EVERY == 0:
+                    save_checkpoint(checkpoint, lines_done())
+    
+    return lines_done()
+
+def download_dataset_images(dataset_file, base_download_dir="downloaded_images", resume=True,
+                            concurrency=DEFAULT_CONCURRENCY, checkpoint=None,
+                            per_host=DEFAULT_PER_HOST):
     """
     Download all images from the dataset and organize them according to image paths.
     
@@ -100,6 +397,10 @@ def download_dataset_images(dataset_file, base_download_dir="downloaded_images",
         dataset_file (str): Path to the JSONL dataset file
         base_download_dir (str): Base directory for downloaded images
         resume (bool): Whether to skip already downloaded files
+        concurrency (int): Maximum number of downloads in flight
+        checkpoint (str): Optional progress file; lines recorded there as
+            processed by a previous run are not read again
+        per_host (int): Maximum number of downloads in flight per host
         
     Returns:
         dict: Statistics about the download process
@@ -117,53 +418,41 @@ def download_dataset_images(dataset_file, base_download_dir="downloaded_images",
     print(f"Dataset file: {dataset_file}")
     print(f"Download directory: {base_path.absolute()}")
     print(f"Resume mode: {resume}")
+    print(f"Concurrency: {concurrency} ({per_host} per host)")
+    
+    start_line = load_checkpoint(checkpoint)
+    if start_line:
+        print(f"Resuming after line {start_line} (checkpoint: {checkpoint})")
     print("-" * 60)
     
+    entries = []
+    line_count = 0
+    
     try:
-        with open(dataset_file, 'r', encoding='utf-8') as f:
+        # Read raw bytes: orjson parses UTF-8 directly, so the text layer's
+        # decoding pass and per-line str copies are skipped
+        with open(dataset_file, 'rb', buffering=1 << 20) as f:
             for line_num, line in enumerate(f, 1):
+                line_count = line_num
+                if line_num <= start_line or line.isspace():
+                    continue
+                
                 try:
-                    data = json.loads(line.strip())
-                    image_path = data.get('image', '')
-                    image_url = data.get('image_url', '')
+                    data = orjson.loads(line)
                     
-                    if not image_path or not image_url:
+                    if not data.get('image') or not data.get('image_url'):
                         print(f"Line {line_num}: Missing image path or URL, skipping")
                         continue
                     
-                    stats['total'] += 1
-                    
-                    # Create local file path based on the image path from dataset
-                    local_file_path = base_path / image_path
-                    
-                    # Check if file already exists and resume is enabled
-                    if resume and local_file_path.exists():
-                        print(f"[{line_num}] Skipping existing file: {local_file_path}")
-                        stats['skipped'] += 1
-                        continue
-                    
-                    print(f"[{line_num}] Processing: {image_path}")
-                    
-                    # Download the image
-                    if download_image(image_url, local_file_path):
-                        stats['successful'] += 1
-                    else:
-                        stats['failed'] += 1
-                    
-                    # Small delay to be respectful to the server
-                    time.sleep(0.5)
+                    entries.append((line_num, data))
                     
-                except json.JSONDecodeError as e:
+                except orjson.JSONDecodeError as e:
                     print(f"Line {line_num}: JSON decode error - {e}")
                     continue
                 except Exception as e:
                     print(f"Line {line_num}: Unexpected error - {e}")
                     continue
                     
-                # Print progress every 50 items
-                if stats['total'] % 50 == 0:
-                    print(f"\nProgress: {stats['total']} processed, {stats['successful']} successful, {stats['failed']} failed, {stats['skipped']} skipped\n")
-                    
     except FileNotFoundError:
         print(f"Error: Dataset file '{dataset_file}' not found")
         return stats
@@ -171,6 +460,15 @@ def download_dataset_images(dataset_file, base_download_dir="downloaded_images",
         print(f"Error reading dataset file: {e}")
         return stats
     
+    stats['total'] = len(entries)
+    next_index = line_count
+    if entries:
+        with logging_redirect_tqdm():
+            next_index = asyncio.run(_download_entries(entries, base_path, resume, concurrency, per_host,
+                                                       stats, checkpoint, line_count))
+    if checkpoint:
+        save_checkpoint(checkpoint, next_index)
+    
     return stats
 
 def print_download_summary(stats):
@@ -219,11 +517,36 @@ def parse_args():
         action="store_true",
         help="Don't resume, re-download existing files"
     )
+    parser.add_argument(
+        "--verbose",
+        action="store_true",
+        help="Log every download, not only failures"
+    )
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=DEFAULT_CONCURRENCY,
+        help=f"Maximum number of concurrent downloads (default: {DEFAULT_CONCURRENCY})"
+    )
+    parser.add_argument(
+        "--per-host",
+        type=int,
+        default=DEFAULT_PER_HOST,
+        help=f"Maximum number of concurrent downloads from a single host (default: {DEFAULT_PER_HOST})"
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Progress file; if it exists, skip the dataset lines it records as processed. "
+             "It never moves past a failed download, so failures are retried on the next run"
+    )
     return parser.parse_args()
 
 def main():
     # Parse command line arguments
     args = parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.verbose:
+        logger.setLevel(logging.DEBUG)
     
     # Determine resume mode
     if args.no_resume:
@@ -245,11 +568,13 @@ def main():
     print(f"Input file: {input_file}")
     print(f"Output directory: {args.output_dir}")
     print(f"Resume mode: {resume}")
+    print(f"Concurrency: {args.concurrency} ({args.per_host} per host)")
     print()
     
     # Start download process
     start_time = time.time()
-    stats = download_dataset_images(str(input_file), args.output_dir, resume)
+    stats = download_dataset_images(str(input_file), args.output_dir, resume, args.concurrency,
+                                    args.checkpoint, args.per_host)
     end_time = time.time()
     
     # Print summary
@@ -266,7 +591,12 @@ def main():
         if subdirs:
             print("Directory structure:")
             for subdir in sorted(subdirs):
-                image_count = len(list(subdir.glob("**/*.png"))) + len(list(subdir.glob("**/*.jpg"))) + len(list(subdir.glob("**/*.jpeg")))
+                image_count = sum(
+                    1
+                    for _, _, files in os.walk(subdir)
+                    for name in files
+                    if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+                )
                 print(f"  {subdir.name}/: {image_count} images")
     
     return 0
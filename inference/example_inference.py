@@ -3,18 +3,51 @@
 run_inference.py
 Run GPT‑4o inference on benchmark examples to identify incorrect reasoning steps.
 Usage:
+    export OPENAI_API_KEY=...
     python example_inference.py --input benchmark.jsonl --output results.jsonl --image_root path/to/images
+    # offline, via the OpenAI Batch API
+    python example_inference.py --mode batch --input benchmark.jsonl --output results.jsonl --image_root path/to/images
+    # encode the images once, then reuse them across runs with --encoded_images images.jsonl
+    python example_inference.py --mode preprocess --input benchmark.jsonl --image_root path/to/images --encoded_images images.jsonl
 """
-import json
+import asyncio
+import functools
+import hashlib
+import io
 import textwrap
 import argparse
-import base64
 import mimetypes
+import mmap
+import multiprocessing
 import os
-from typing import Dict
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+from urllib.parse import quote, urljoin
+import httpx
 import openai
+import orjson
 from tqdm import tqdm
 
+try:
+    import pybase64 as base64  # SIMD encoder, same API and output
+except ImportError:
+    import base64
+
+try:
+    from PIL import Image  # only needed for --max_image_side
+except ImportError:
+    Image = None
+
+try:
+    import uvloop  # faster event loop, used when installed
+except ImportError:
+    uvloop = None
+
+# Serialize each JSONL record together with its newline
+JSONL_OPTIONS = orjson.OPT_APPEND_NEWLINE
+
 # ──────────────────────────────────────────────────────────────────
 # 1) SYSTEM PROMPT                                                   │
 # ──────────────────────────────────────────────────────────────────
@@ -32,92 +65,627 @@ Your task is to determine:
 Return exactly one of the step labels as your final answer.
 Do not explain your answer.
 """)
+SYSTEM_MESSAGE = {"role": "system", "content": INFERENCE_SYSTEM_PROMPT}
+
+# Dedented once here rather than on every call; filled per entry
+USER_PROMPT_TEMPLATE = textwrap.dedent("""\
+    Question: {question}
+
+    Step-by-step reasoning:
+    {reasoning}
+
+    Step options:
+    {step_options}
+    """)
 
 # ──────────────────────────────────────────────────────────────────
 # 2) IMAGE ENCODING                                                  │
 # ──────────────────────────────────────────────────────────────────
-def encode_image(path: str) -> Dict:
-    """Encode image file to base64 and return as dict with url and detail."""
-    mime_type, _ = mimetypes.guess_type(path)
-    if not mime_type:
-        mime_type = "image/jpeg"
-    with open(path, "rb") as f:
-        encoded = base64.b64encode(f.read()).decode("utf-8")
+def downscale_image(path: str, max_side: int) -> Optional[tuple]:
+    """Shrink the image at ``path`` to fit in ``max_side`` x ``max_side``.
+
+    Returns ``(data, mime_type)`` for the re-encoded image, or None if it
+    already fits. JPEGs stay JPEG; everything else becomes PNG so diagrams keep
+    sharp edges and transparency.
+    """
+    with Image.open(path) as img:
+        if max(img.size) <= max_side:
+            return None
+        fmt = "JPEG" if img.format == "JPEG" else "PNG"
+        img.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+        buf = io.BytesIO()
+        if fmt == "JPEG":
+            img.save(buf, fmt, quality=85, optimize=True)
+        else:
+            img.save(buf, fmt, optimize=True)
+    return buf.getvalue(), f"image/{fmt.lower()}"
+
+def encode_image(path: str, max_side: int = 0) -> Dict:
+    """Encode image file to base64 and return as dict with url and detail.
+
+    With ``max_side`` set, larger images are downscaled first, which cuts both
+    the request size and the image tokens billed.
+    """
+    resized = downscale_image(path, max_side) if max_side else None
+    if resized:
+        data, mime_type = resized
+    else:
+        mime_type, _ = mimetypes.guess_type(path)
+        if not mime_type:
+            mime_type = "image/jpeg"
+        with open(path, "rb") as f:
+            data = f.read()
+    encoded = base64.b64encode(data).decode("ascii")
     return {"url": f"data:{mime_type};base64,{encoded}", "detail": "auto"}
 
+def try_encode_image(path: str, max_side: int = 0) -> Optional[Dict]:
+    """Like ``encode_image``, but return None for an image that cannot be read."""
+    try:
+        return encode_image(path, max_side)
+    except OSError:
+        return None
+
+class EncodedImageFile:
+    """Read-only view of a sidecar file of pre-encoded images (``--mode preprocess``).
+
+    Each line holds ``{"image": <name from the benchmark>, "url": ..., "detail": ...}``,
+    with ``image`` first. Only the position of every line is kept in memory;
+    opening the file reads just the image name at the start of each line, and
+    a record is parsed from the memory-mapped file when it is looked up.
+    """
+
+    _PREFIX = b'{"image":'
+    # Ends the image name: inside a JSON string every quote is escaped
+    _NAME_END = b'","url":'
+
+    def __init__(self, path: str):
+        self._offsets: Dict[str, tuple] = {}
+        with open(path, "rb") as f:
+            # mmap cannot map an empty file
+            empty = os.fstat(f.fileno()).st_size == 0
+            self._mm = b"" if empty else mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = 0
+        while offset < len(self._mm):
+            end = self._mm.find(b"\n", offset)
+            end = len(self._mm) if end == -1 else end + 1
+            # Check the first byte so a (multi-MB) record line is not copied
+            if self._mm[offset:offset + 1] == b"{" or not self._mm[offset:end].isspace():
+                self._offsets[self._image_name(offset, end)] = (offset, end - offset)
+            offset = end
+
+    def _image_name(self, offset: int, end: int) -> str:
+        """Return the image name of the line at ``offset``, parsing only its prefix."""
+        start = offset + len(self._PREFIX)
+        name_end = self._mm.find(self._NAME_END, start, end)
+        if self._mm[offset:start] == self._PREFIX and name_end != -1:
+            return orjson.loads(self._mm[start:name_end + 1])
+        return orjson.loads(self._mm[offset:end])["image"]
+
+    def get(self, image: str) -> Optional[Dict]:
+        location = self._offsets.get(image)
+        if location is None:
+            return None
+        offset, length = location
+        record = orjson.loads(self._mm[offset:offset + length])
+        del record["image"]
+        return record
+
+class ImageCache:
+    """LRU cache of encoded images keyed by benchmark image name, bounded by total encoded size.
+
+    Benchmarks reuse one image across several questions, so each file is read
+    and encoded once while it stays in the cache. Images found in ``encoded``
+    are taken from there instead of being encoded. Misses are encoded on
+    ``encoder`` if given, else in the calling thread. Safe to share between the
+    encoding threads; the returned dicts must not be modified.
+    """
+
+    def __init__(self, image_root: str, max_bytes: int, encoded: Optional[EncodedImageFile] = None,
+                 max_side: int = 0, encoder: Optional[Executor] = None):
+        self.image_root = image_root
+        self.max_bytes = max_bytes
+        self.max_side = max_side
+        self.encoded = encoded
+        self.encoder = encoder
+        self._images: "OrderedDict[str, Dict]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, image: str) -> Dict:
+        with self._lock:
+            cached = self._images.get(image)
+            if cached is not None:
+                self._images.move_to_end(image)
+                return cached
+
+        encoded = self.encoded.get(image) if self.encoded else None
+        if encoded is None:
+            path = os.path.join(self.image_root, image)
+            if self.encoder:
+                encoded = self.encoder.submit(encode_image, path, self.max_side).result()
+            else:
+                encoded = encode_image(path, self.max_side)
+        size = len(encoded["url"])
+        with self._lock:
+            if image not in self._images and size <= self.max_bytes:
+                self._images[image] = encoded
+                self._size += size
+                while self._size > self.max_bytes:
+                    _, evicted = self._images.popitem(last=False)
+                    self._size -= len(evicted["url"])
+        return encoded
+
+def hosted_image(base_url: str, image: str) -> Dict:
+    """Reference an image by its URL under ``base_url`` instead of inlining its bytes."""
+    return {"url": urljoin(base_url.rstrip("/") + "/", quote(image)), "detail": "auto"}
+
+def open_image_cache(args: argparse.Namespace, encoder: Optional[Executor] = None) -> ImageCache:
+    """Create the image cache for a run, backed by ``args.encoded_images`` if given."""
+    encoded = EncodedImageFile(args.encoded_images) if args.encoded_images else None
+    return ImageCache(args.image_root, args.image_cache_mb * 1024 * 1024, encoded,
+                      args.max_image_side, encoder)
+
+def preprocess_images(lines: List[Dict], args: argparse.Namespace) -> None:
+    """Encode every distinct image referenced by ``lines`` once into ``args.encoded_images``.
+
+    Encoding is CPU-bound and holds the GIL, so it runs on a process pool, in
+    chunks to keep the per-image IPC overhead small.
+    Images that cannot be read are reported and left out; inference falls back
+    to encoding them (and failing) as usual.
+    """
+    images = list(dict.fromkeys(entry["image"] for entry in lines))
+    paths = [os.path.join(args.image_root, image) for image in images]
+    missing = 0
+    with ProcessPoolExecutor() as pool, open(args.encoded_images, "wb") as f:
+        encode = functools.partial(try_encode_image, max_side=args.max_image_side)
+        results = pool.map(encode, paths, chunksize=32)
+        for image, encoded in zip(images, tqdm(results, total=len(paths), desc="Encoding images")):
+            if encoded is None:
+                missing += 1
+                continue
+            # "image" first, so EncodedImageFile can read it without parsing the url
+            f.write(orjson.dumps({"image": image, **encoded}, option=JSONL_OPTIONS))
+    print(f"[INFO] Encoded {len(images) - missing} images, {missing} could not be read")
+
 # ──────────────────────────────────────────────────────────────────
 # 3) GPT CALL                                                        │
 # ──────────────────────────────────────────────────────────────────
-def run_inference_on_entry(entry: Dict, image_root: str, model: str = "gpt-4o") -> str:
-    client = openai.Client(api_key="")  # your key
-    
+def create_client(max_connections: int, max_retries: int = 2) -> openai.AsyncOpenAI:
+    """Create the client shared by all requests, reading OPENAI_API_KEY.
+
+    The connection pool is sized to the request concurrency so every in-flight
+    request keeps its connection alive for the next one. Rate limits (429),
+    timeouts, connection errors and 5xx responses are retried by the SDK up to
+    ``max_retries`` times, with jittered exponential backoff that honors the
+    server's Retry-After header.
+    """
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=max_connections)
+    return openai.AsyncOpenAI(http_client=openai.DefaultAsyncHttpxClient(limits=limits),
+                              max_retries=max_retries)
+
+class RateLimiter:
+    """Space request starts evenly so that at most ``per_minute`` begin per minute.
+
+    Only the first attempt of each request goes through the limiter; retries
+    made by the SDK are paced by its own backoff instead.
+    """
+
+    def __init__(self, per_minute: float):
+        self.interval = 60.0 / per_minute
+        self._next_start = 0.0
+
+    async def acquire(self) -> None:
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_start)
+        self._next_start = start + self.interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+def build_messages(entry: Dict, image_input: Dict, detail: str = "auto") -> List[Dict]:
+    """Build the chat messages for one benchmark entry and its encoded image."""
     step_options = entry["step_options"]
     reasoning = entry["corrupted_cot"]
     
-    # Build full image path and encode
-    image_path = os.path.join(image_root, entry["image"])
-    image_input = encode_image(image_path)
-    
     # Construct user prompt with both text and image
     user_prompt = [
         {
             "type": "text",
-            "text": textwrap.dedent(f"""\
-                Question: {entry['question_text']}
-                
-                Step-by-step reasoning:
-                {reasoning}
-                
-                Step options:
-                {step_options}
-                """)
+            "text": USER_PROMPT_TEMPLATE.format(question=entry["question_text"],
+                                                reasoning=reasoning,
+                                                step_options=step_options)
         },
         {
             "type": "image_url",
-            "image_url": image_input
+            "image_url": {**image_input, "detail": detail}
         }
     ]
     
-    rsp = client.chat.completions.create(
+    return [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": user_prompt}
+    ]
+
+async def run_inference_on_entry(client: openai.AsyncOpenAI, entry: Dict, image_input: Dict,
+                                 model: str = "gpt-4o", detail: str = "auto") -> str:
+    rsp = await client.chat.completions.create(
         model=model,
-        messages=[
-            {"role": "system", "content": INFERENCE_SYSTEM_PROMPT},
-            {"role": "user", "content": user_prompt}
-        ]
+        messages=build_messages(entry, image_input, detail)
     )
     
     prediction = rsp.choices[0].message.content.strip()
     return prediction
 
 # ──────────────────────────────────────────────────────────────────
-# 4) MAIN SCRIPT                                                     │
+# 4) BATCH API                                                       │
+# ──────────────────────────────────────────────────────────────────
+BATCH_FINAL_STATES = {"completed", "failed", "expired", "cancelled"}
+BATCH_MAX_REQUESTS = 50_000  # API limit per batch input file
+BATCH_MAX_BYTES = 190 * 1000 * 1000  # API limit is 200 MB per file; keep some headroom
+
+def write_batch_input(lines: List[Dict], todo: List[int], args: argparse.Namespace,
+                      path_prefix: str, predictions: Dict[int, str],
+                      images: Optional[ImageCache]) -> List[str]:
+    """Write one Batch API request per entry of ``lines`` indexed by ``todo`` to ``<path_prefix>.<n>.jsonl``.
+
+    A new file is started whenever the next request would take the current one
+    past ``BATCH_MAX_REQUESTS`` requests or ``BATCH_MAX_BYTES``, the API's
+    limits per batch. Entries whose request cannot be built (e.g. a missing
+    image) are left out and get an error prediction in ``predictions`` right
+    away. Returns the paths of the files written.
+    """
+    paths: List[str] = []
+    f = None
+    count = size = 0
+    try:
+        for i in todo:
+            try:
+                if args.image_url_base:
+                    image_input = hosted_image(args.image_url_base, lines[i]["image"])
+                else:
+                    image_input = images.get(lines[i]["image"])
+                body = {"model": args.model,
+                        "messages": build_messages(lines[i], image_input, args.image_detail)}
+                row = orjson.dumps({"custom_id": str(i), "method": "POST",
+                                    "url": "/v1/chat/completions", "body": body}, option=JSONL_OPTIONS)
+            except Exception as e:
+                predictions[i] = f"[ERROR] {e}"
+                continue
+            if len(row) > BATCH_MAX_BYTES:
+                predictions[i] = f"[ERROR] request of {len(row)} bytes exceeds the batch input limit"
+                continue
+            if f is None or count == BATCH_MAX_REQUESTS or size + len(row) > BATCH_MAX_BYTES:
+                if f is not None:
+                    f.close()
+                paths.append(f"{path_prefix}.{len(paths)}.jsonl")
+                f = open(paths[-1], "wb")
+                count = size = 0
+            f.write(row)
+            count += 1
+            size += len(row)
+    finally:
+        if f is not None:
+            f.close()
+    return paths
+
+def parse_batch_result(row: Dict) -> str:
+    """Return the prediction, or an error prediction, for one Batch API output row."""
+    if row.get("error"):
+        return f"[ERROR] {row['error'].get('message')}"
+    response = row["response"]
+    body = response.get("body") or {}
+    if response.get("status_code") != 200:
+        error = body.get("error") or {}
+        return f"[ERROR] {error.get('message', response.get('status_code'))}"
+    return body["choices"][0]["message"]["content"].strip()
+
+async def run_batch(lines: List[Dict], args: argparse.Namespace, todo: List[int],
+                    append: bool = False) -> bool:
+    """Run inference on the entries indexed by ``todo`` through the OpenAI Batch API and write the results.
+
+    The requests are written to ``<output>.batch_input.<n>.jsonl`` files within
+    the API's size limits, uploaded and submitted as one batch each, and the
+    files are deleted again (or the batches in ``args.batch_id`` are picked up
+    again); the batches are polled every ``args.poll_interval`` seconds until
+    they finish. Results are written in
+    input order; entries without a result (their batch failed, expired or was
+    cancelled) are left out so that a rerun picks them up. With ``append`` the
+    output file is appended to instead of truncated. Returns whether every
+    batch completed; only then is the checkpoint advanced.
+    """
+    predictions: Dict[int, str] = {}
+    complete = True
+
+    async with create_client(args.max_concurrency, args.max_retries) as client:
+        batches = []
+        if args.batch_id:
+            batches = [await client.batches.retrieve(batch_id) for batch_id in args.batch_id]
+        else:
+            images = None if args.image_url_base else open_image_cache(args)
+            batch_paths = write_batch_input(lines, todo, args, args.output + ".batch_input",
+                                            predictions, images)
+            try:
+                for batch_path in batch_paths:
+                    with open(batch_path, "rb") as f:
+                        batch_file = await client.files.create(file=f, purpose="batch")
+                    batch = await client.batches.create(input_file_id=batch_file.id,
+                                                        endpoint="/v1/chat/completions",
+                                                        completion_window="24h")
+                    batches.append(batch)
+                    print(f"[INFO] Submitted batch {batch.id} ({len(batches)}/{len(batch_paths)})")
+            finally:
+                # Each holds up to BATCH_MAX_BYTES of inlined images; once
+                # uploaded (or if the upload failed) they are of no further use
+                for batch_path in batch_paths:
+                    os.remove(batch_path)
+            if batches:
+                print(f"[INFO] Resume polling with --batch_id {' '.join(batch.id for batch in batches)}")
+
+        for batch in batches:
+            while batch.status not in BATCH_FINAL_STATES:
+                counts = batch.request_counts
+                if counts:
+                    print(f"[INFO] Batch {batch.id}: {batch.status}, {counts.completed + counts.failed}/{counts.total} done")
+                await asyncio.sleep(args.poll_interval)
+                batch = await client.batches.retrieve(batch.id)
+
+            complete = complete and batch.status == "completed"
+            print(f"[INFO] Batch {batch.id} {batch.status}")
+            if batch.errors and batch.errors.data:
+                for error in batch.errors.data:
+                    print(f"[WARN] {error.message}")
+
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    content = await client.files.content(file_id)
+                    for line in content.content.splitlines():
+                        if line.strip():
+                            row = orjson.loads(line)
+                            predictions[int(row["custom_id"])] = parse_batch_result(row)
+
+    buf = bytearray()
+    for i in todo:
+        if i in predictions:
+            lines[i]["gpt4o_prediction"] = predictions[i]
+            buf += orjson.dumps(lines[i], option=JSONL_OPTIONS)
+    with open(args.output, "ab" if append else "wb") as out_file:
+        out_file.write(buf)
+
+    if complete and args.checkpoint:
+        # Stop at the first entry without an answer, like the online checkpoint;
+        # a completed batch may still be missing a row
+        save_checkpoint(args.checkpoint, next((i for i in todo if i not in predictions or is_error(lines[i])),
+                                              len(lines)))
+    return complete
+
+# ──────────────────────────────────────────────────────────────────
+# 5) MAIN SCRIPT                                                     │
 # ──────────────────────────────────────────────────────────────────
+CHECKPOINT_EVERY = 25  # completed entries between checkpoint writes
+FLUSH_BYTES = 256 * 1024  # output file buffer: serialized results per write
+ENCODE_WORKERS = 8  # threads reading and encoding images ahead of requests
+
+def load_checkpoint(path: Optional[str]) -> int:
+    """Return the index of the first unprocessed entry, or 0 without a checkpoint."""
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())["next_index"]
+
+def save_checkpoint(path: str, next_index: int) -> None:
+    """Atomically record that all entries before ``next_index`` are done."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps({"next_index": next_index}))
+    os.replace(tmp_path, path)
+
+def entry_key(entry: Dict):
+    """Return the stable identity of an entry: its id, else a hash of its image and question."""
+    if "id" in entry:
+        return entry["id"]
+    text = f"{entry['image']}\0{entry['question_text']}".encode("utf-8")
+    return hashlib.blake2b(text, digest_size=16).hexdigest()
+
+def is_error(entry: Dict) -> bool:
+    """Return whether the prediction recorded for ``entry`` is an error rather than an answer."""
+    return entry.get("gpt4o_prediction", "").startswith("[ERROR]")
+
+def load_finished(path: str) -> Set:
+    """Return the keys of the entries already answered in the output file at ``path``.
+
+    Error rows (an outage, a bad key, a failed batch) are dropped from the file
+    and their entries are run again, as is a final line cut short by a crash;
+    the file is rewritten atomically only when there is something to drop.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb") as f:
+        data = f.read()
+
+    finished = set()
+    kept = bytearray()
+    end = data.rfind(b"\n") + 1
+    for line in data[:end].splitlines(keepends=True):
+        if line.isspace():
+            continue
+        entry = orjson.loads(line)
+        if not is_error(entry):
+            finished.add(entry_key(entry))
+            kept += line
+    if len(kept) < len(data):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(kept)
+        os.replace(tmp_path, path)
+    return finished
+
+async def run_inference(lines: List[Dict], args: argparse.Namespace, todo: List[int],
+                        append: bool = False) -> None:
+    """Run inference on the entries indexed by ``todo`` concurrently and stream results to the output file.
+
+    At most ``args.max_concurrency`` requests are in flight. Images are read and
+    encoded on a thread pool up to ``args.prefetch`` entries ahead, so that
+    work overlaps the network wait instead of blocking the event loop between
+    requests. With ``args.max_image_side`` set, the decode and resize are
+    CPU-bound, so the threads hand them to a process pool. Results are written
+    in completion order by this coroutine alone, so lines never interleave, and
+    are batched into writes of about ``FLUSH_BYTES`` to keep syscalls rare.
+    With ``args.checkpoint`` set, the index below which every entry has been
+    answered is saved every ``CHECKPOINT_EVERY`` completions, so it stops at
+    the first error; entries not in ``todo`` count as answered. With
+    ``append`` the output file is appended to instead of truncated.
+    """
+    client = create_client(args.max_concurrency, args.max_retries)
+    sem = asyncio.Semaphore(args.max_concurrency)
+    limiter = RateLimiter(args.rpm) if args.rpm else None
+    # Entries holding an encoded image: those in flight plus those prefetched,
+    # which bounds the memory taken by encoded images
+    prefetch_sem = asyncio.Semaphore(args.max_concurrency + args.prefetch)
+    pool = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+    # Spawned, not forked: the workers start on the first submit, from an
+    # encoder thread, and forking a process with running threads is unsafe
+    resize_pool = (ProcessPoolExecutor(max_workers=ENCODE_WORKERS,
+                                       mp_context=multiprocessing.get_context("spawn"))
+                   if args.max_image_side else None)
+    images = None if args.image_url_base else open_image_cache(args, resize_pool)
+    loop = asyncio.get_running_loop()
+
+    async def run_one(i: int, entry: Dict) -> int:
+        async with prefetch_sem:
+            try:
+                if args.image_url_base:
+                    image_input = hosted_image(args.image_url_base, entry["image"])
+                else:
+                    image_input = await loop.run_in_executor(pool, images.get, entry["image"])
+                async with sem:
+                    if limiter:
+                        await limiter.acquire()
+                    prediction = await run_inference_on_entry(client, entry, image_input, model=args.model,
+                                                              detail=args.image_detail)
+                entry["gpt4o_prediction"] = prediction
+            except Exception as e:
+                entry["gpt4o_prediction"] = f"[ERROR] {e}"
+        return i
+
+    finished = [True] * len(lines)
+    for i in todo:
+        finished[i] = False
+    next_index = todo[0] if todo else len(lines)
+
+    try:
+        async with client:
+            tasks = [asyncio.create_task(run_one(i, lines[i])) for i in todo]
+            # The file's own FLUSH_BYTES buffer batches the writes, and closing
+            # it flushes what is buffered even when the run is interrupted
+            with pool, open(args.output, "ab" if append else "wb", buffering=FLUSH_BYTES) as out_file:
+                for completed, task in enumerate(
+                        tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="GPT-4o inference"), 1):
+                    i = await task
+                    out_file.write(orjson.dumps(lines[i], option=JSONL_OPTIONS))
+
+                    # Error rows are written but stay unfinished, so the
+                    # checkpoint never moves past an entry that needs a retry
+                    finished[i] = not is_error(lines[i])
+                    while next_index < len(lines) and finished[next_index]:
+                        next_index += 1
+
+                    # Results must be on disk before the checkpoint claims them
+                    checkpoint_due = args.checkpoint and completed % CHECKPOINT_EVERY == 0
+                    if checkpoint_due:
+                        out_file.flush()
+                        save_checkpoint(args.checkpoint, next_index)
+    finally:
+        if resize_pool:
+            resize_pool.shutdown()
+    if args.checkpoint:
+        save_checkpoint(args.checkpoint, next_index)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--input", type=str, required=True,
                         help="Path to benchmark .jsonl file")
-    parser.add_argument("--output", type=str, required=True,
-                        help="Path to save results .jsonl")
+    parser.add_argument("--output", type=str, default=None,
+                        help="Path to save results .jsonl (not used by --mode preprocess)")
     parser.add_argument("--image_root", type=str, required=True,
                         help="Folder containing image files")
+    parser.add_argument("--image_url_base", type=str, default=None,
+                        help="Public URL under which image_root is served; images are then sent as "
+                             "links instead of inlined base64, so the images are not read, resized "
+                             "or taken from --encoded_images (default: inline)")
+    parser.add_argument("--image_detail", choices=["auto", "low", "high"], default="auto",
+                        help="Vision detail level; 'low' bills a fixed small token count per image (default: auto)")
+    parser.add_argument("--max_image_side", type=int, default=0,
+                        help="Downscale images whose longer side exceeds this many pixels before "
+                             "encoding, e.g. 768; needs Pillow (default: 0, send images unchanged)")
     parser.add_argument("--model", type=str, default="gpt-4o",
                         help="Model name (default: gpt-4o)")
+    parser.add_argument("--max_concurrency", type=int, default=16,
+                        help="Maximum number of requests in flight (default: 16)")
+    parser.add_argument("--max_retries", type=int, default=5,
+                        help="Retries per request on rate limits, timeouts and server errors (default: 5)")
+    parser.add_argument("--rpm", type=float, default=None,
+                        help="Maximum entries started per minute, e.g. a bit under the account's RPM limit; "
+                             "only first attempts are paced, --max_retries retries come on top "
+                             "(default: no limit)")
+    parser.add_argument("--prefetch", type=int, default=16,
+                        help="Images encoded ahead of the requests in flight (default: 16)")
+    parser.add_argument("--image_cache_mb", type=int, default=512,
+                        help="Memory for encoded images reused across entries, 0 to disable (default: 512)")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="Progress file; if it exists, resume after the entries it records as done. "
+                             "It never moves past an entry whose prediction is an error")
+    parser.add_argument("--no_resume", action="store_true",
+                        help="Overwrite an existing --output instead of skipping the entries it already "
+                             "answers; without it, error rows are dropped and those entries run again")
+    parser.add_argument("--mode", choices=["online", "batch", "preprocess"], default="online",
+                        help="online: concurrent requests; batch: one OpenAI Batch API job, "
+                             "half price but may take up to 24h; preprocess: only encode the "
+                             "images into --encoded_images (default: online)")
+    parser.add_argument("--encoded_images", type=str, default=None,
+                        help="Sidecar .jsonl of pre-encoded images, written by --mode preprocess "
+                             "and read by the other modes")
+    parser.add_argument("--poll_interval", type=float, default=60,
+                        help="Seconds between batch status checks (default: 60)")
+    parser.add_argument("--batch_id", type=str, nargs="+", default=None,
+                        help="Resume waiting for previously submitted batches instead of submitting new ones")
     args = parser.parse_args()
+    if args.mode == "preprocess" and not args.encoded_images:
+        parser.error("--mode preprocess requires --encoded_images")
+    if args.mode != "preprocess" and not args.output:
+        parser.error("--output is required")
+    if args.max_image_side and Image is None:
+        parser.error("--max_image_side requires Pillow (pip install pillow)")
+    if args.image_url_base and (args.max_image_side or args.encoded_images):
+        parser.error("--image_url_base sends links to the original images; "
+                     "it cannot be combined with --max_image_side or --encoded_images")
 
-    with open(args.input, "r") as f:
-        lines = [json.loads(line) for line in f if line.strip()]
+    with open(args.input, "rb") as f:
+        lines = [orjson.loads(line) for line in f if not line.isspace()]
 
-    print(f"[INFO] Running inference on {len(lines)} examples...")
+    if args.mode == "preprocess":
+        preprocess_images(lines, args)
+        print(f"[✓] Encoded images saved to {args.encoded_images}")
+        raise SystemExit(0)
 
-    out_file = open(args.output, "w", encoding="utf-8")
-    for i, entry in enumerate(tqdm(lines, desc="GPT-4o inference")):
-        try:
-            prediction = run_inference_on_entry(entry, args.image_root, model=args.model)
-            entry["gpt4o_prediction"] = prediction
-        except Exception as e:
-            entry["gpt4o_prediction"] = f"[ERROR] {e}"
+    start = load_checkpoint(args.checkpoint)
+    if start:
+        print(f"[INFO] Resuming from checkpoint at entry {start}")
+    finished = set() if args.no_resume else load_finished(args.output)
+    todo = [i for i in range(start, len(lines)) if entry_key(lines[i]) not in finished]
+    if finished:
+        print(f"[INFO] Skipping {len(lines) - start - len(todo)} entries already in {args.output}")
+    print(f"[INFO] Running inference on {len(todo)} examples...")
 
-        out_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+    append = bool(start or finished)
+    run = uvloop.run if uvloop else asyncio.run
+    if args.mode == "batch":
+        if not run(run_batch(lines, args, todo, append)):
+            print(f"[ERROR] Not every batch completed; partial results saved to {args.output}, "
+                  f"rerun to retry the remaining entries")
+            raise SystemExit(1)
+    else:
+        run(run_inference(lines, args, todo, append))
 
-    out_file.close()
     print(f"[✓] Inference complete. Results saved to {args.output}")